@@ -1,8 +1,11 @@
 import atexit
+import copy
 import math
 import os
+import queue
 import random
 import threading
+from functools import lru_cache
 from glob import glob
 
 import chess
@@ -36,35 +39,89 @@ def resolve_engine_path():
 
 
 ENGINE_PATH = resolve_engine_path()
+CPU_COUNT = os.cpu_count() or 2
+ENGINE_THREADS = max(1, int(os.environ.get("SF_THREADS", CPU_COUNT - 1)))
+ENGINE_HASH_MB = int(os.environ.get("SF_HASH_MB", "256"))
+ENGINE_POOL_SIZE = max(1, int(os.environ.get("SF_POOL_SIZE", CPU_COUNT // ENGINE_THREADS)))
+ANALYSIS_CACHE_SIZE = 1000
 
 app = Flask(__name__, static_folder="static", static_url_path="/static")
 
-engine_lock = threading.Lock()
-engine = None
+engines_lock = threading.Lock()
+engines = []
+engine_pool = queue.Queue()
 last_options = {}
 
+# Slots start empty; an engine is opened on first checkout and after it dies.
+for _ in range(ENGINE_POOL_SIZE):
+    engine_pool.put(None)
 
-def get_engine():
-    global engine
+
+def open_engine():
     if not os.path.isfile(ENGINE_PATH):
         raise FileNotFoundError(f"Stockfish not found: {ENGINE_PATH}")
-    if engine is None:
-        engine = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
-    return engine
+    engine_instance = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
+    try:
+        engine_instance.configure({"Threads": ENGINE_THREADS, "Hash": ENGINE_HASH_MB})
+    except Exception:
+        try:
+            engine_instance.quit()
+        except Exception:
+            pass
+        raise
+    with engines_lock:
+        engines.append(engine_instance)
+        last_options[id(engine_instance)] = {}
+    return engine_instance
 
 
-def configure_engine(options):
-    global last_options
-    if options == last_options:
-        return
-    engine_instance = get_engine()
+def checkout_engine():
+    engine_instance = engine_pool.get()
+    if engine_instance is None:
+        try:
+            engine_instance = open_engine()
+        except Exception:
+            engine_pool.put(None)
+            raise
+    return engine_instance
+
+
+def discard_engine(engine_instance):
+    with engines_lock:
+        if engine_instance in engines:
+            engines.remove(engine_instance)
+        last_options.pop(id(engine_instance), None)
     try:
-        engine_instance.configure(options)
-        last_options = dict(options)
-    except chess.engine.EngineError:
+        engine_instance.quit()
+    except Exception:
         pass
 
 
+def option_default(engine_instance, key):
+    option = engine_instance.options.get(key)
+    return option.default if option is not None else None
+
+
+def configure_engine(engine_instance, options):
+    # Skip options this Stockfish build doesn't declare (e.g. Contempt was removed
+    # in SF 14) and clamp spins to the declared range (e.g. UCI_Elo starts at 1320
+    # in current builds); otherwise the whole setoption batch is rejected.
+    applied = last_options[id(engine_instance)]
+    delta = {}
+    for key, value in options.items():
+        option = engine_instance.options.get(key)
+        if option is None:
+            continue
+        if option.min is not None and option.max is not None:
+            value = max(option.min, min(value, option.max))
+        if applied.get(key) != value:
+            delta[key] = value
+    if not delta:
+        return
+    engine_instance.configure(delta)
+    applied.update(delta)
+
+
 def serialize_score(score):
     if score is None:
         return {"type": "cp", "value": 0}
@@ -142,6 +199,48 @@ def imgs(filename):
     return send_from_directory(os.path.join(BASE_DIR, "imgs"), filename)
 
 
+@lru_cache(maxsize=ANALYSIS_CACHE_SIZE)
+def analyse_position(fen, depth, multipv, skill, limit_strength, elo, contempt):
+    engine_instance = checkout_engine()
+    try:
+        # Unset options go out as the engine defaults so a pooled engine never keeps
+        # a value from an earlier request that the cache key doesn't record.
+        if skill is None:
+            skill = option_default(engine_instance, "Skill Level")
+        if elo is None:
+            elo = option_default(engine_instance, "UCI_Elo")
+        options = {
+            "Skill Level": skill,
+            "UCI_LimitStrength": limit_strength,
+            "UCI_Elo": elo,
+            "Contempt": contempt,
+        }
+        configure_engine(engine_instance, options)
+        info = engine_instance.analyse(
+            chess.Board(fen), chess.engine.Limit(depth=depth), multipv=multipv
+        )
+    except chess.engine.EngineError:
+        discard_engine(engine_instance)
+        engine_instance = None
+        raise
+    finally:
+        engine_pool.put(engine_instance)
+
+    if not isinstance(info, list):
+        info = [info]
+
+    lines = []
+    for line in info:
+        pv_moves = [move.uci() for move in line.get("pv", [])]
+        lines.append(
+            {
+                "score": serialize_score(line.get("score")),
+                "pv": pv_moves,
+            }
+        )
+    return tuple(lines)
+
+
 @app.route("/api/analyze", methods=["POST"])
 def analyze():
     payload = request.get_json(silent=True) or {}
@@ -161,40 +260,27 @@ def analyze():
     except ValueError:
         return jsonify({"error": "Invalid FEN"}), 400
 
-    try:
-        engine_instance = get_engine()
-    except FileNotFoundError as exc:
-        return jsonify({"error": str(exc)}), 500
-
-    with engine_lock:
-        options = {}
-        if skill is not None:
-            options["Skill Level"] = max(0, min(int(skill), 20))
-        options["UCI_LimitStrength"] = limit_strength
-        if limit_strength and elo is not None:
-            options["UCI_Elo"] = max(800, min(int(elo), 2850))
-        style_map = {
-            "passive": -20,
-            "normal": 0,
-            "aggressive": 20,
-        }
-        options["Contempt"] = style_map.get(style, 0)
-        configure_engine(options)
-        info = engine_instance.analyse(board, chess.engine.Limit(depth=depth), multipv=multipv)
-
-    if not isinstance(info, list):
-        info = [info]
+    if skill is not None:
+        skill = max(0, min(int(skill), 20))
+    if limit_strength and elo is not None:
+        elo = max(800, min(int(elo), 2850))
+    else:
+        elo = None
+    style_map = {
+        "passive": -20,
+        "normal": 0,
+        "aggressive": 20,
+    }
 
-    lines = []
-    for line in info:
-        pv_moves = [move.uci() for move in line.get("pv", [])]
-        lines.append(
-            {
-                "score": serialize_score(line.get("score")),
-                "pv": pv_moves,
-            }
+    try:
+        lines = analyse_position(
+            board.fen(), depth, multipv, skill, limit_strength, elo, style_map.get(style, 0)
         )
+    except (FileNotFoundError, chess.engine.EngineError) as exc:
+        return jsonify({"error": str(exc)}), 500
 
+    # Cached lines are shared between requests; hand this request its own copy.
+    lines = copy.deepcopy(list(lines))
     engine_best = lines[0]["pv"][0] if lines and lines[0]["pv"] else None
     best = (
         choose_humanized_best(lines, board.turn, human_level, human_mode)
@@ -214,14 +300,14 @@ def analyze():
 
 
 @atexit.register
-def close_engine():
-    global engine
-    if engine is not None:
-        try:
-            engine.quit()
-        except Exception:
-            pass
-        engine = None
+def close_engines():
+    with engines_lock:
+        for engine_instance in engines:
+            try:
+                engine_instance.quit()
+            except Exception:
+                pass
+        engines.clear()
 
 
 if __name__ == "__main__":
@@ -2,20 +2,27 @@ import argparse
 import json
 import os
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 
 import cv2
 import mss
 import numpy as np
 import requests
-import win32gui
 
 
 CALIBRATION_PATH = os.path.join(os.path.dirname(__file__), "calibration.json")
 TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "templates")
 
+MIN_ALPHA = 128
+OCCUPANCY_STD_RATIO = 0.5
+
+_TEMPLATE_STACK_CACHE: Dict[Tuple[int, float], "TemplateStack"] = {}
+_SCT_LOCAL = threading.local()
+
 
 @dataclass
 class Calibration:
@@ -33,7 +40,24 @@ class Calibration:
         return self.bottom - self.top
 
 
+@dataclass
+class TemplateStack:
+    names: List[str]
+    tiles: np.ndarray
+    masks: np.ndarray
+    areas: np.ndarray
+    min_std: float
+
+
+def _get_win32gui():
+    # Windows-only; imported on demand so the rest of the module loads elsewhere.
+    import win32gui
+
+    return win32gui
+
+
 def find_window_rect(title_substring: str) -> Tuple[int, int, int, int]:
+    win32gui = _get_win32gui()
     matches = []
 
     def enum_handler(hwnd, _):
@@ -52,12 +76,32 @@ def find_window_rect(title_substring: str) -> Tuple[int, int, int, int]:
     return rect
 
 
-def grab_window(rect: Tuple[int, int, int, int]) -> np.ndarray:
+def get_sct() -> "mss.base.MSSBase":
+    # MSS handles are not thread-safe, so keep one instance per thread.
+    sct = getattr(_SCT_LOCAL, "sct", None)
+    if sct is None:
+        sct = mss.mss()
+        _SCT_LOCAL.sct = sct
+    return sct
+
+
+def grab_window_raw(rect: Tuple[int, int, int, int]) -> np.ndarray:
     left, top, right, bottom = rect
-    with mss.mss() as sct:
-        region = {"left": left, "top": top, "width": right - left, "height": bottom - top}
-        image = np.array(sct.grab(region))
-        return cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    region = {"left": left, "top": top, "width": right - left, "height": bottom - top}
+    return np.asarray(get_sct().grab(region))
+
+
+def to_bgr(image: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(image[:, :, :3])
+
+
+def grab_window(rect: Tuple[int, int, int, int]) -> np.ndarray:
+    return to_bgr(grab_window_raw(rect))
+
+
+def thumbnail_hash(image: np.ndarray) -> int:
+    thumb = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA)
+    return hash(thumb.tobytes())
 
 
 def save_calibration(calibration: Calibration) -> None:
@@ -100,42 +144,119 @@ def calibrate_board(image: np.ndarray) -> Calibration:
     return Calibration(left=left, top=top, right=right, bottom=bottom)
 
 
+def template_cache_key(square_size: int) -> Tuple[int, float]:
+    # Directory mtime catches added/removed files, file mtimes catch edits.
+    mtimes = [os.path.getmtime(TEMPLATES_DIR)]
+    for name in os.listdir(TEMPLATES_DIR):
+        if name.lower().endswith(".png"):
+            mtimes.append(os.path.getmtime(os.path.join(TEMPLATES_DIR, name)))
+    return square_size, max(mtimes)
+
+
 def load_templates(square_size: int) -> Dict[str, np.ndarray]:
     pieces = {}
     for name in os.listdir(TEMPLATES_DIR):
         if not name.lower().endswith(".png"):
             continue
         path = os.path.join(TEMPLATES_DIR, name)
-        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
         if img is None:
             continue
+        if img.ndim != 3 or img.shape[2] != 4:
+            raise RuntimeError(f"Template has no alpha channel (needs a transparent PNG): {path}")
         resized = cv2.resize(img, (square_size, square_size), interpolation=cv2.INTER_AREA)
-        edges = cv2.Canny(resized, 40, 120)
         key = os.path.splitext(name)[0]
-        pieces[key] = edges
+        pieces[key] = resized
     if not pieces:
-        raise RuntimeError("No templates found in pc_capture/templates.")
+        raise RuntimeError("No BGRA templates found in pc_capture/templates.")
     return pieces
 
 
-def match_piece(square: np.ndarray, templates: Dict[str, np.ndarray], threshold: float) -> str:
-    square_gray = cv2.cvtColor(square, cv2.COLOR_BGR2GRAY)
-    square_gray = cv2.GaussianBlur(square_gray, (3, 3), 0)
-    square_edges = cv2.Canny(square_gray, 40, 120)
-    edge_density = float(np.count_nonzero(square_edges)) / float(square_edges.size)
-    if edge_density < 0.02:
-        return ""
-    best_score = -1.0
-    best_piece = ""
-    for name, tpl in templates.items():
-        res = cv2.matchTemplate(square_edges, tpl, cv2.TM_CCOEFF_NORMED)
-        score = float(res.max())
-        if score > best_score:
-            best_score = score
-            best_piece = name
-    if best_score < threshold:
-        return ""
-    return best_piece
+def board_grayscale(board_img: np.ndarray, square_size: int) -> np.ndarray:
+    size = square_size * 8
+    code = cv2.COLOR_BGRA2GRAY if board_img.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+    return cv2.cvtColor(board_img[:size, :size], code)
+
+
+def square_views(image: np.ndarray, square_size: int) -> np.ndarray:
+    # Zero-copy (8, 8, s, s[, c]) view of the board, one tile per square.
+    # reshape raises if the board is smaller than 8 squares a side.
+    board = image[: square_size * 8, : square_size * 8]
+    return board.reshape(8, square_size, 8, square_size, *board.shape[2:]).swapaxes(1, 2)
+
+
+def square_sums(integral: np.ndarray, square_size: int) -> np.ndarray:
+    corners = np.arange(9) * square_size
+    sums = integral[np.ix_(corners, corners)].astype(np.float64)
+    return sums[1:, 1:] - sums[:-1, 1:] - sums[1:, :-1] + sums[:-1, :-1]
+
+
+def occupancy_mask(board_gray: np.ndarray, square_size: int, min_std: float) -> np.ndarray:
+    # Empty squares are flat; per-square variance comes from four integral-image lookups.
+    total, total_sq = cv2.integral2(board_gray)
+    area = float(square_size * square_size)
+    mean = square_sums(total, square_size) / area
+    variance = square_sums(total_sq, square_size) / area - mean * mean
+    return variance >= min_std * min_std
+
+
+def load_template_stack(cache_key: Tuple[int, float]) -> TemplateStack:
+    square_size = cache_key[0]
+    cached = _TEMPLATE_STACK_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    templates = load_templates(square_size)
+    names = list(templates)
+    images = np.stack([templates[name] for name in names])
+    gray = np.stack([cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY) for img in images]).astype(np.float64)
+    # Only the opaque piece pixels are matched; the transparent background would
+    # otherwise read as black and never correlate with a light or dark square.
+    masks = (images[..., 3] >= MIN_ALPHA).astype(np.float64)
+    areas = masks.sum(axis=(1, 2))
+    means = (gray * masks).sum(axis=(1, 2)) / areas
+    tiles = masks * (gray - means[:, None, None])
+    spreads = np.sqrt((tiles * tiles).sum(axis=(1, 2)))
+    # A piece on a flat square of its own mean brightness is the least contrasted
+    # it can look: its square std is then sqrt(coverage * variance inside the mask).
+    # Gate empty squares at a fraction of the weakest template's value.
+    min_std = OCCUPANCY_STD_RATIO * float((spreads / square_size).min())
+    stack = TemplateStack(
+        names=names,
+        tiles=tiles / np.maximum(spreads, 1e-6)[:, None, None],
+        masks=masks,
+        areas=areas,
+        min_std=min_std,
+    )
+    _TEMPLATE_STACK_CACHE.clear()
+    _TEMPLATE_STACK_CACHE[cache_key] = stack
+    return stack
+
+
+def match_board(
+    board_gray: np.ndarray, template_stack: TemplateStack, square_size: int, threshold: float
+) -> List[List[str]]:
+    # Masked TM_CCOEFF_NORMED of every occupied square against every template:
+    # the numerator and the per-mask square statistics are three contractions.
+    grid = [[""] * 8 for _ in range(8)]
+    occupied = occupancy_mask(board_gray, square_size, template_stack.min_std)
+    if not occupied.any():
+        return grid
+
+    tiles = square_views(board_gray, square_size)[occupied].astype(np.float64)
+    axes = ([1, 2], [1, 2])
+    numerator = np.tensordot(tiles, template_stack.tiles, axes=axes)
+    sums = np.tensordot(tiles, template_stack.masks, axes=axes)
+    sums_sq = np.tensordot(tiles * tiles, template_stack.masks, axes=axes)
+    spread_sq = sums_sq - sums * sums / template_stack.areas
+    scores = numerator / np.sqrt(np.maximum(spread_sq, 1e-6))
+
+    best = scores.argmax(axis=1)
+    best_scores = scores[np.arange(best.size), best]
+    ranks, files = np.nonzero(occupied)
+    for rank, file, index, score in zip(ranks, files, best, best_scores):
+        if score >= threshold:
+            grid[rank][file] = template_stack.names[index]
+    return grid
 
 
 def build_fen(pieces_grid) -> str:
@@ -173,6 +294,18 @@ def guess_orientation(grid) -> bool:
     return top_white > bottom_white
 
 
+def post_fen(server: str, fen: str) -> None:
+    try:
+        resp = requests.post(
+            f"{server.rstrip('/')}/api/analyze",
+            json={"fen": fen, "depth": 16, "multipv": 3},
+            timeout=10,
+        )
+        print("Server response:", resp.text)
+    except Exception as exc:
+        print("Server error:", exc)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--title", default="Chess.com", help="Window title substring")
@@ -192,41 +325,52 @@ def main():
     if debug_dir:
         os.makedirs(debug_dir, exist_ok=True)
 
-    while True:
-        rect = find_window_rect(args.title)
-        window_img = grab_window(rect)
+    if args.calibrate:
+        window_img = grab_window(find_window_rect(args.title))
+        calibration = calibrate_board(window_img)
+        save_calibration(calibration)
+        print("Saved calibration:", calibration)
+        return
 
-        if args.calibrate:
-            calibration = calibrate_board(window_img)
-            save_calibration(calibration)
-            print("Saved calibration:", calibration)
-            return
+    calibration = load_calibration()
+    square_size = int(min(calibration.width, calibration.height) / 8)
 
-        calibration = load_calibration()
-        board_img = window_img[
+    executor = ThreadPoolExecutor(max_workers=1) if args.post else None
+    pending = None
+    last_hash = None
+    while True:
+        rect = find_window_rect(args.title)
+        raw_img = grab_window_raw(rect)
+        raw_board = raw_img[
             calibration.top : calibration.bottom, calibration.left : calibration.right
         ]
-        square_size = int(min(calibration.width, calibration.height) / 8)
-        templates = load_templates(square_size)
-
+        # Skip matching and posting while the board looks the same as last time.
+        board_hash = thumbnail_hash(raw_board)
+        if board_hash == last_hash:
+            time.sleep(max(1, args.interval))
+            continue
+        last_hash = board_hash
+
+        template_stack = load_template_stack(template_cache_key(square_size))
+        # One BGRA->gray pass over the board feeds every square; no BGR copy is made.
+        names = match_board(
+            board_grayscale(raw_board, square_size),
+            template_stack,
+            square_size,
+            args.threshold,
+        )
+        grid = [[piece_to_fen(name) for name in row] for row in names]
         if debug_dir:
-            cv2.imwrite(os.path.join(debug_dir, "window.png"), window_img)
+            board_img = to_bgr(raw_board)
+            cv2.imwrite(os.path.join(debug_dir, "window.png"), to_bgr(raw_img))
             cv2.imwrite(os.path.join(debug_dir, "board.png"), board_img)
-
-        grid = []
-        for rank in range(8):
-            row = []
-            for file in range(8):
-                x1 = file * square_size
-                y1 = rank * square_size
-                square = board_img[y1 : y1 + square_size, x1 : x1 + square_size]
-                name = match_piece(square, templates, args.threshold)
-                row.append(piece_to_fen(name))
-                if debug_dir:
+            squares = square_views(board_img, square_size)
+            for rank in range(8):
+                for file in range(8):
                     cv2.imwrite(
-                        os.path.join(debug_dir, f"square_{rank}_{file}.png"), square
+                        os.path.join(debug_dir, f"square_{rank}_{file}.png"),
+                        np.ascontiguousarray(squares[rank, file]),
                     )
-            grid.append(row)
 
         if args.auto_side:
             should_flip = guess_orientation(grid)
@@ -241,22 +385,21 @@ def main():
         if fen.startswith("8/8/8/8/8/8/8/8"):
             print("Warning: board appears empty. Check templates/threshold/calibration.")
 
-        if args.post:
-            try:
-                resp = requests.post(
-                    f"{args.post.rstrip('/')}/api/analyze",
-                    json={"fen": fen, "depth": 16, "multipv": 3},
-                    timeout=10,
-                )
-                print("Server response:", resp.text)
-            except Exception as exc:
-                print("Server error:", exc)
+        if executor is not None:
+            if pending is not None and not pending.done():
+                # Previous analysis still running; retry this position next tick.
+                last_hash = None
+            else:
+                pending = executor.submit(post_fen, args.post, fen)
 
         if args.once:
             break
 
         time.sleep(max(1, args.interval))
 
+    if executor is not None:
+        executor.shutdown(wait=True)
+
 
 if __name__ == "__main__":
     try: